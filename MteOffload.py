@@ -0,0 +1,228 @@
+# The MIT License (MIT)
+#
+# Copyright (c) Eclypses, Inc.
+#
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import multiprocessing
+import time
+
+import gevent
+import gevent.queue
+from gevent.threadpool import ThreadPool
+
+from MteBase import MteBase
+
+class MteOffload():
+    """Class MteOffload
+
+        This runs CPU heavy MTE operations off of the gevent loop so they do
+        not block every other locust user in the process while they run.
+
+        The mode "thread" runs them on native threads, relying on the MTE
+        library releasing the GIL during its native calls. The mode "process"
+        runs them in worker processes, which each initialize the MTE license.
+        Only operations on messages of at least threshold bytes are
+        offloaded.
+
+        Functions given to run must be importable module level functions
+        taking and returning picklable values, as they may be sent to a
+        worker process.
+
+        A worker process is only handed out again once its previous call has
+        finished, even if the waiting greenlet was killed, so a late result
+        can never reach another caller. If the call itself fails, e.g. the
+        worker died, the worker is replaced from a separate greenlet.
+    """
+    def __init__(self, mode, threshold, workers, license_company=None, license_key=None):
+        if mode not in ("thread", "process"):
+            raise Exception("Invalid offload mode: " + str(mode))
+        self.mode = mode
+        self.threshold = threshold
+
+        # Native threads, which in process mode just wait on the workers.
+        self.pool = ThreadPool(workers)
+
+        # Start worker processes. Spawn is used so they do not inherit the
+        # gevent patched state of this process.
+        self.license_company = license_company
+        self.license_key = license_key
+        self.closed = False
+        self.idle_workers = None
+        self.workers = {}
+        if self.mode == "process":
+            self.context = multiprocessing.get_context("spawn")
+            self.idle_workers = gevent.queue.Queue()
+            for i in range(workers):
+                self.idle_workers.put(self._start_worker())
+
+    def should_offload(self, size):
+        """Returns true if an operation on size bytes should be offloaded."""
+        return size >= self.threshold
+
+    def run(self, function, *args):
+        """Runs the function off of the gevent loop and returns its result.
+            Only the calling greenlet waits for it.
+        """
+        if self.mode == "thread":
+            return self.pool.apply(function, args)
+
+        # Wait for a free worker process.
+        conn = self.idle_workers.get()
+
+        # The worker is released when the native thread's call is done, not
+        # when this greenlet stops waiting on it.
+        call = self.pool.spawn(_worker_call, conn, function, args)
+        call.rawlink(lambda call: self._release_worker(conn, call))
+        (success, result) = call.get()
+
+        if not success:
+            raise result
+        return result
+
+    def close(self):
+        """Stops the worker processes and threads."""
+        self.closed = True
+        for (conn, process) in list(self.workers.items()):
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self.workers = {}
+        self.pool.kill()
+
+    def _start_worker(self):
+        """Starts a worker process and returns the connection to it."""
+        (parent_conn, child_conn) = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child_conn, self.license_company, self.license_key), daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[parent_conn] = process
+        return parent_conn
+
+    def _release_worker(self, conn, call):
+        """Makes the worker available again once its call is done. This runs
+            as a callback in the gevent hub, so a failed worker is replaced
+            from a separate greenlet rather than here.
+        """
+        if self.closed:
+            return
+
+        # The call has returned, so the pipe has been read and is clean.
+        if call.successful():
+            self.idle_workers.put(conn)
+            return
+
+        gevent.spawn(self._replace_worker, conn)
+
+    def _replace_worker(self, conn):
+        """Retires a failed worker and starts a new one in its place. The
+            new process is started on a native thread so the gevent loop is
+            not blocked, and starting is retried until it succeeds so the
+            pool never runs out of workers.
+        """
+        process = self.workers.pop(conn, None)
+        conn.close()
+        if process != None:
+            process.terminate()
+
+        while not self.closed:
+            try:
+                new_conn = self.pool.apply(self._start_worker)
+            except Exception as ex:
+                print("Failed to start offload worker, retrying:", ex)
+                gevent.sleep(1)
+                continue
+
+            # Closed while starting, so stop the new worker too.
+            if self.closed:
+                process = self.workers.pop(new_conn, None)
+                new_conn.close()
+                if process != None:
+                    process.terminate()
+                break
+
+            self.idle_workers.put(new_conn)
+            break
+
+def _worker_call(conn, function, args):
+    """Sends the call to a worker process and waits for its result. This runs
+        on a native thread.
+    """
+    conn.send((function, args))
+    return conn.recv()
+
+def _worker_main(conn, license_company, license_key):
+    """Main loop of a worker process. Runs each call received until None is
+        received.
+    """
+    if license_company != None and not MteBase.init_license(license_company, license_key):
+        print("Offload worker license init error.")
+
+    while True:
+        message = conn.recv()
+        if message == None:
+            break
+        (function, args) = message
+        try:
+            conn.send((True, function(*args)))
+        except Exception as ex:
+            conn.send((False, ex))
+
+class LoopMonitor():
+    """Class LoopMonitor
+
+        This measures how long the gevent loop is blocked. A greenlet sleeps
+        for interval seconds at a time, and any time past that it did not
+        get back is time the loop was blocked. Each sample is passed to the
+        callback in seconds.
+    """
+    def __init__(self, interval, callback=None):
+        self.interval = interval
+        self.callback = callback
+        self.total_blocked = 0
+        self.max_blocked = 0
+        self.greenlet = None
+
+    def start(self):
+        """Starts the monitoring greenlet."""
+        self.greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        """Stops the monitoring greenlet."""
+        if self.greenlet != None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def _run(self):
+        """Monitoring loop."""
+        while True:
+            start_time = time.perf_counter()
+            gevent.sleep(self.interval)
+            blocked = max(0, time.perf_counter() - start_time - self.interval)
+
+            self.total_blocked += blocked
+            self.max_blocked = max(self.max_blocked, blocked)
+            if self.callback != None:
+                self.callback(blocked)
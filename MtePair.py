@@ -22,7 +22,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import base64
+import contextlib
 import sys
+import time
+
+import gevent.lock
 
 from MteBase import MteBase
 from MteEnc import MteEnc
@@ -49,10 +53,36 @@ class MtePair():
         Setup will require the necessary kyber and MTE initial information to 
         be properly passed in. Every encoding or decoding operation will restore
         and save the respective state.
+
+        An optional random source with a get_bytes(size) method may be given
+        in place of MteRandom, e.g. a seeded one for reproducible runs.
+
+        The kyber strength may be 512, 768 or 1024. The time spent on kyber
+        key generation, secret decryption and MTE instantiation is kept in
+        keygen_time, decrypt_time and instantiate_time (seconds).
+
+        If an MteOffload is given, instantiation and any encoding or decoding
+        of messages past its threshold run off of the gevent loop. Operations
+        on the same pair are still run one at a time.
     """
-    def __init__(self, type):
+    KYBER_STRENGTHS = (512, 768, 1024)
+
+    def __init__(self, type, rand=None, kyber_strength=512, offload=None):
        
-        rand = MteRandom()
+        self.offload = offload
+        self.lock = None
+        if self.offload is not None:
+            self.lock = gevent.lock.Semaphore()
+
+        if kyber_strength not in MtePair.KYBER_STRENGTHS:
+            raise Exception("Invalid kyber strength: " + str(kyber_strength))
+        self.kyber_strength = kyber_strength
+        self.keygen_time = 0
+        self.decrypt_time = 0
+        self.instantiate_time = 0
+
+        if rand is None:
+            rand = MteRandom()
         self.enc_personal = base64.b64encode(rand.get_bytes(36)).decode("utf-8")
         self.dec_personal = base64.b64encode(rand.get_bytes(36)).decode("utf-8")
         self.enc_nonce = 0
@@ -76,8 +106,8 @@ class MtePair():
         # Create kyber instances
         self.enc_kyber = MteKyber.MteKyber()
         self.dec_kyber = MteKyber.MteKyber()
-        self.enc_kyber.init(512)
-        self.dec_kyber.init(512)
+        self.enc_kyber.init(self.kyber_strength)
+        self.dec_kyber.init(self.kyber_strength)
 
         # Set entropy for kyber instances.
         kyber_entropy_size = self.enc_kyber.get_min_entropy_size()
@@ -85,6 +115,7 @@ class MtePair():
         self.dec_kyber.set_entropy(rand.get_bytes(kyber_entropy_size))
 
         # Create keypairs for kyber.
+        start_time = time.perf_counter()
         self.enc_pub_key = bytearray(self.enc_kyber.get_public_key_size())
         self.dec_pub_key = bytearray(self.dec_kyber.get_public_key_size())
         kyber_status = self.enc_kyber.create_keypair(self.enc_pub_key)
@@ -93,12 +124,14 @@ class MtePair():
         kyber_status = self.dec_kyber.create_keypair(self.dec_pub_key)
         if kyber_status != MteKyber.Success:
             raise Exception("Failed to create decoder public key: " + str(kyber_status))
+        self.keygen_time = time.perf_counter() - start_time
 
     def setup(self, enc_nonce, dec_nonce, enc_encrypted_secret, dec_encrypted_secret):
         """Requires the nonces and kyber encrypted secrets from their counterpart
            device. 
         """
         # Decrypt secrets.
+        start_time = time.perf_counter()
         enc_secret = bytearray(self.enc_kyber.get_secret_size())
         kyber_status = self.enc_kyber.decrypt_secret(enc_encrypted_secret, enc_secret)
         if kyber_status != MteKyber.Success:
@@ -110,32 +143,25 @@ class MtePair():
         if kyber_status != MteKyber.Success:
            print("Failed to decrypt decoder kyber secret!")
            return kyber_status
+        self.decrypt_time = time.perf_counter() - start_time
 
-        # Create encoder.
-        encoder = MteEnc.fromdefault()
-        encoder.set_entropy(enc_secret)
-        encoder.set_nonce(enc_nonce)
-        status = encoder.instantiate(self.enc_personal)
-        if status != MteStatus.mte_status_success:
-            print("Failed to instantiate encoder!")
-            return status
-        
-        # Save encoder state.
-        self.encoder_state = encoder.save_state()
-        del encoder
+        with self._serialize():
+            # Create encoder and save its state.
+            (encoder_state, status, encoder_time) = self._run(_instantiate_state, True, enc_secret, enc_nonce, self.enc_personal)
+            if status != MteStatus.mte_status_success:
+                print("Failed to instantiate encoder!")
+                return status
+            self.encoder_state = encoder_state
 
-        # Create decoder.        
-        decoder = MteDec.fromdefault()
-        decoder.set_entropy(dec_secret)
-        decoder.set_nonce(dec_nonce)
-        status = decoder.instantiate(self.dec_personal)
-        if status != MteStatus.mte_status_success:
-            print("Failed to instantiate decoder!")
-            return status
-        
-        # Save decoder state.
-        self.decoder_state = decoder.save_state()
-        del decoder
+            # Create decoder and save its state.
+            (decoder_state, status, decoder_time) = self._run(_instantiate_state, False, dec_secret, dec_nonce, self.dec_personal)
+            if status != MteStatus.mte_status_success:
+                print("Failed to instantiate decoder!")
+                return status
+            self.decoder_state = decoder_state
+
+        # Timed where instantiation runs, so it leaves out offload waits.
+        self.instantiate_time = encoder_time + decoder_time
         
         # Success.
         return MteStatus.mte_status_success
@@ -145,6 +171,9 @@ class MtePair():
             encoder state. The message will then be encoded. Following a
             successful outcome, the state will be saved.
         """
+        if self.offload is not None:
+            return self._offloaded_encoder("encode", message, "Error encoding message")
+
         # Restore encoder.
         encoder = self._restore_encoder()
 
@@ -169,6 +198,9 @@ class MtePair():
             encoder state. The message will then be encoded. Following a
             successful outcome, the state will be saved.
         """    
+        if self.offload is not None:
+            return self._offloaded_encoder("encode_b64", message, "Error base64 encoding message")
+
         # Restore encoder.
         encoder = self._restore_encoder()
 
@@ -188,11 +220,30 @@ class MtePair():
         # Return the encoded message and success status.  
         return (encoded_message, status)  
     
+    def encode_b64url(self, message):
+        """Encodes the given message to unpadded URL-safe base64. This will
+            first restore the previous encoder state. The message will then be
+            encoded. Following a successful outcome, the state will be saved.
+
+            The raw MTE output is base64 encoded here with the URL-safe
+            alphabet rather than by MTE, so the result can be used directly in
+            a url path or header without a percent-quoting pass.
+        """
+        (encoded_message, status) = self.encode(message)
+        if status != MteStatus.mte_status_success:
+            return (None, status)
+
+        # Return the URL-safe encoded message and success status.
+        return (base64.urlsafe_b64encode(encoded_message).rstrip(b"=").decode("ascii"), status)
+
     def decode(self, encoded_message):
         """Decodes the given encoded message. This will first restore the
             previous decoder state. The message will then be decoded. Following
             a successful outcome, the state will be saved.
         """
+        if self.offload is not None:
+            return self._offloaded_decoder("decode", encoded_message, "Error decoding message")
+
         # Restore decoder.
         decoder = self._restore_decoder()
 
@@ -217,6 +268,9 @@ class MtePair():
             previous decoder state. The message will then be decoded. Following
             a successful outcome, the state will be saved.
         """
+        if self.offload is not None:
+            return self._offloaded_decoder("decode_b64", encoded_message, "Error base64 decoding message")
+
         # Restore decoder.
         decoder = self._restore_decoder()
 
@@ -236,6 +290,68 @@ class MtePair():
         # Return the decoded message and status.
         return (decoded_message, status)
     
+    def _offloaded_encoder(self, method, message, error):
+        """Runs the encoder method on the message through the offload, if it
+            is large enough, while holding this pair's lock.
+        """
+        with self._serialize():
+            if self.offload.should_offload(len(message)):
+                (encoded_message, status, state) = self.offload.run(_run_encoder, self.type, self.encoder_state, method, message)
+            else:
+                (encoded_message, status, state) = _run_encoder(self.type, self.encoder_state, method, message)
+
+            if status != MteStatus.mte_status_success:
+                print("{0}: Status: ({1}): {2}".format(
+                    error,
+                    MteBase.get_status_name(status),
+                    MteBase.get_status_description(status)),
+                    file=sys.stderr)
+                # Return none and status.
+                return (None, status)
+
+            # Save encoder.
+            self.encoder_state = state
+
+        # Return the encoded message and success status.
+        return (encoded_message, status)
+
+    def _offloaded_decoder(self, method, encoded_message, error):
+        """Runs the decoder method on the encoded message through the
+            offload, if it is large enough, while holding this pair's lock.
+        """
+        with self._serialize():
+            if self.offload.should_offload(len(encoded_message)):
+                (decoded_message, status, state) = self.offload.run(_run_decoder, self.type, self.decoder_state, method, encoded_message)
+            else:
+                (decoded_message, status, state) = _run_decoder(self.type, self.decoder_state, method, encoded_message)
+
+            if MteBase.status_is_error(status):
+                print("{0}: Status: ({1}): {2}".format(
+                    error,
+                    MteBase.get_status_name(status),
+                    MteBase.get_status_description(status)),
+                    file=sys.stderr)
+                # Return none and status.
+                return (None, status)
+
+            # Save decoder.
+            self.decoder_state = state
+
+        # Return the decoded message and status.
+        return (decoded_message, status)
+
+    def _run(self, function, *args):
+        """Runs the function through the offload if there is one."""
+        if self.offload is not None:
+            return self.offload.run(function, *args)
+        return function(*args)
+
+    def _serialize(self):
+        """Returns this pair's lock, or a no-op if not offloading."""
+        if self.lock is not None:
+            return self.lock
+        return contextlib.nullcontext()
+
     def _restore_encoder(self):
         """Restores the encoder state."""
         # Create encoder based on type.
@@ -280,4 +396,65 @@ class MtePair():
     def _save_decoder(self, decoder):
         """Saves the decoder state."""
         # Save state.
-        self.decoder_state = decoder.save_state() 
\ No newline at end of file
+        self.decoder_state = decoder.save_state() 
+
+# The functions below only take and return picklable values so they can be
+# run by MteOffload, including in a worker process.
+
+def _instantiate_state(is_encoder, secret, nonce, personal):
+    """Instantiates an encoder or decoder. Returns its state, status and the
+        time it took in seconds.
+    """
+    start_time = time.perf_counter()
+    if is_encoder:
+        mte = MteEnc.fromdefault()
+    else:
+        mte = MteDec.fromdefault()
+    mte.set_entropy(secret)
+    mte.set_nonce(nonce)
+    status = mte.instantiate(personal)
+    if status != MteStatus.mte_status_success:
+        return (None, status, time.perf_counter() - start_time)
+
+    state = mte.save_state()
+    return (state, status, time.perf_counter() - start_time)
+
+def _run_encoder(type, state, method, message):
+    """Restores the encoder state and runs the encoder method on the message.
+        Returns the encoded message, status and new encoder state.
+    """
+    # Create encoder based on type.
+    if type == 1:
+        encoder = MteMkeEnc.fromdefault()
+    else:
+        encoder = MteEnc.fromdefault()
+
+    status = encoder.restore_state(state)
+    if status != MteStatus.mte_status_success:
+        return (None, status, state)
+
+    (encoded_message, status) = getattr(encoder, method)(message)
+    if status != MteStatus.mte_status_success:
+        return (None, status, state)
+
+    return (encoded_message, status, encoder.save_state())
+
+def _run_decoder(type, state, method, encoded_message):
+    """Restores the decoder state and runs the decoder method on the encoded
+        message. Returns the decoded message, status and new decoder state.
+    """
+    # Create decoder based on type.
+    if type == 1:
+        decoder = MteMkeDec.fromdefault()
+    else:
+        decoder = MteDec.fromdefault()
+
+    status = decoder.restore_state(state)
+    if status != MteStatus.mte_status_success:
+        return (None, status, state)
+
+    (decoded_message, status) = getattr(decoder, method)(encoded_message)
+    if MteBase.status_is_error(status):
+        return (None, status, state)
+
+    return (decoded_message, status, decoder.save_state())
@@ -0,0 +1,170 @@
+# The MIT License (MIT)
+#
+# Copyright (c) Eclypses, Inc.
+#
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import json
+import random
+import time
+
+class TrafficRecorder():
+    """Class TrafficRecorder
+
+        This records the request trace of a run.
+
+        Each request made by a locust user is written as one compact JSON line
+        holding the user stream, the inter-arrival time since that user's
+        previous request, the scenario (test_type), the api name, the method,
+        the query string, the header type and the payload size in bytes.
+    """
+    def __init__(self, file_name):
+        # Line buffered so the trace is complete even if locust is stopped.
+        self.file = open(file_name, "w", buffering=1)
+        self.total_users = 0
+
+    def register_user(self):
+        """Returns a new user stream id and the time to measure its first
+            request from.
+        """
+        user_id = self.total_users
+        self.total_users += 1
+        return (user_id, time.perf_counter())
+
+    def record(self, user_id, last_time, scenario, name, header_type, payload, query_string, method):
+        """Writes one request to the trace. Returns the time this request was
+            recorded at, to be passed in as last_time for the next request.
+        """
+        now = time.perf_counter()
+
+        # Only the size of the payload is kept, see TrafficStream.
+        payload_size = 0
+        if payload:
+            payload_size = len(json.dumps(payload))
+
+        entry = {
+            "u": user_id,
+            "t": round(now - last_time, 6),
+            "s": scenario,
+            "n": name,
+            "m": method,
+            "q": query_string,
+            "h": header_type,
+            "p": payload_size
+        }
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+        return now
+
+    def close(self):
+        """Closes the trace file."""
+        self.file.close()
+
+class TrafficReplayer():
+    """Class TrafficReplayer
+
+        This loads a trace written by TrafficRecorder and hands out one
+        TrafficStream per locust user. Streams are handed out in the order
+        they were recorded and wrap around if more users are spawned than were
+        recorded.
+
+        Speed scales the recorded inter-arrival times, e.g. 2.0 replays the
+        trace twice as fast.
+    """
+    def __init__(self, file_name, speed=1.0):
+        if speed <= 0:
+            raise ValueError("Replay speed must be greater than zero: " + str(speed))
+        self.speed = speed
+
+        # Group entries by the user stream they were recorded on.
+        self.streams = {}
+        with open(file_name, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.streams.setdefault(entry["u"], []).append(entry)
+
+        if len(self.streams) == 0:
+            raise ValueError("Trace file has no requests: " + file_name)
+
+        self.stream_ids = sorted(self.streams)
+        self.stream_index = 0
+
+    def next_stream(self):
+        """Returns the next user stream to replay."""
+        user_id = self.stream_ids[self.stream_index % len(self.stream_ids)]
+        # Number of times the streams have been handed out before this one.
+        wrap = self.stream_index // len(self.stream_ids)
+        self.stream_index += 1
+        return TrafficStream(user_id, wrap, self.streams[user_id], self.speed)
+
+class TrafficStream():
+    """Class TrafficStream
+
+        This is the recorded request sequence of a single user. Requests are
+        scheduled against the start of the stream rather than the end of the
+        previous response, so the original arrival times are kept regardless
+        of how long each response takes.
+    """
+    def __init__(self, user_id, wrap, entries, speed):
+        self.user_id = user_id
+        self.wrap = wrap
+        self.entries = entries
+        self.speed = speed
+        self.index = 0
+        self.next_time = time.perf_counter()
+
+    def next_entry(self):
+        """Returns the next entry along with how long to wait before sending
+            it, or (None, 0) when the stream is finished.
+        """
+        if self.index >= len(self.entries):
+            return (None, 0)
+
+        entry = self.entries[self.index]
+        self.index += 1
+
+        # Schedule from the previous request's start time.
+        self.next_time += entry["t"] / self.speed
+        delay = max(0, self.next_time - time.perf_counter())
+
+        return (entry, delay)
+
+class SeededRandom():
+    """Class SeededRandom
+
+        A stand-in for MteRandom that produces the same bytes for the same
+        seed. This makes personalization strings, pair ids and kyber entropy
+        repeatable between runs.
+
+        The seed is made from all of the given parts, e.g. the run seed and
+        the user, so different parts never share a seed.
+
+        This is NOT cryptographically secure and should only be used against
+        a local relay stand-in.
+    """
+    def __init__(self, *seed_parts):
+        # String seeds are hashed, so (1, 2) and (2, 1) differ.
+        self.rand = random.Random(repr(seed_parts))
+
+    def get_bytes(self, size):
+        """Returns the given number of seeded random bytes."""
+        return self.rand.randbytes(size)
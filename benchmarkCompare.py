@@ -0,0 +1,334 @@
+# The MIT License (MIT)
+#
+# Copyright (c) Eclypses, Inc.
+#
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import argparse
+import csv
+import glob
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+# Locust csv columns compared, along with whether a larger value is better
+# and the percentile it is, if it is one.
+METRICS = {
+    "p50": ("50%", False, 0.50),
+    "p95": ("95%", False, 0.95),
+    "p99": ("99%", False, 0.99),
+    "rps": ("Requests/s", True, None),
+}
+
+# Columns of the timings file.
+TIMING_COLUMNS = ["Type", "Name", "Milliseconds", "Bytes"]
+
+# A percentile is only tested if each run has at least this many samples
+# past it, e.g. 2000 samples for p99. Otherwise the relative threshold is
+# applied alone.
+MIN_TAIL_SAMPLES = 20
+
+# Most samples kept per name in the history.
+SAMPLE_LIMIT = 2000
+
+# Baselines kept per history key.
+HISTORY_KEEP = 10
+
+class TimingLog():
+    """Class TimingLog
+
+        This writes one row per timing sample to a csv file kept apart from
+        the locust stats. Each process writes its own PREFIX_timings_PID.csv
+        so locust worker processes do not overwrite each other, and
+        load_run merges them back together. It holds per-request
+        latencies, which are independent samples for the statistical test, as
+        well as timings that are not requests (stage timings, handshake
+        profiling, event loop blocking) so they do not skew the request stats.
+    """
+    def __init__(self, prefix):
+        self.file = open("{0}_timings_{1}.csv".format(prefix, os.getpid()), "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(TIMING_COLUMNS)
+
+    def write(self, type, name, milliseconds, size):
+        """Writes one timing sample."""
+        self.writer.writerow([type, name, round(milliseconds, 4), size])
+
+    def close(self):
+        """Closes the timings file."""
+        self.file.close()
+
+def row_key(row):
+    """Returns the name a row is aligned on, e.g. "POST /api/login". Timings
+        with a custom type (stage timings, handshake profiling) keep it as
+        part of the name so they are never mixed with http requests.
+    """
+    return (row.get("Type", "") + " " + row["Name"]).strip()
+
+def to_float(value):
+    """Returns the csv value as a float or None if it is not set."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value):
+        return None
+    return value
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the values."""
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def limit_samples(samples):
+    """Returns at most SAMPLE_LIMIT of the samples, picked uniformly with a
+        fixed seed so the same input always gives the same output.
+    """
+    if len(samples) <= SAMPLE_LIMIT:
+        return list(samples)
+    return random.Random(0).sample(samples, SAMPLE_LIMIT)
+
+def load_run(prefix):
+    """Loads a locust run written with --csv PREFIX. The stats file gives the
+        summary for each request name.
+
+        If any PREFIX_timings*.csv files exist (see TimingLog), their
+        per-request
+        latencies are used as samples for the statistical test, and its
+        other timings are added as their own names with percentiles worked
+        out from the samples. Without it only the relative threshold is
+        applied.
+    """
+    stats_file = prefix + "_stats.csv"
+    if not os.path.exists(stats_file):
+        raise FileNotFoundError("Locust stats file not found: " + stats_file)
+
+    run = {}
+    with open(stats_file, newline="") as file:
+        for row in csv.DictReader(file):
+            run[row_key(row)] = {
+                "stats": {metric: to_float(row.get(column)) for metric, (column, _, _) in METRICS.items()},
+                "samples": [],
+            }
+
+    # Merge the timings written by each process.
+    timings = {}
+    for timings_file in sorted(glob.glob(glob.escape(prefix) + "_timings*.csv")):
+        with open(timings_file, newline="") as file:
+            for row in csv.DictReader(file):
+                value = to_float(row.get("Milliseconds"))
+                if value != None:
+                    timings.setdefault(row_key(row), []).append(value)
+
+    if len(timings) > 0:
+
+        for name, samples in timings.items():
+            if name in run:
+                # Request latencies, which also make up "Aggregated".
+                run[name]["samples"] = samples
+                if "Aggregated" in run:
+                    run["Aggregated"]["samples"].extend(samples)
+            else:
+                # Timings that are not requests.
+                run[name] = {
+                    "stats": {metric: (percentile(samples, fraction) if fraction != None else None) for metric, (_, _, fraction) in METRICS.items()},
+                    "samples": samples,
+                }
+
+    return run
+
+def quantile_p_value(baseline, candidate, fraction):
+    """One-sided quantile test of a single percentile. Returns the p-value
+        that more of the candidate's samples lie past the baseline's
+        percentile than the baseline's own, i.e. that the candidate's
+        percentile is larger. Uses a two-proportion z test.
+    """
+    limit = percentile(baseline, fraction)
+    base_past = sum(1 for value in baseline if value > limit) / len(baseline)
+    cand_past = sum(1 for value in candidate if value > limit) / len(candidate)
+
+    pooled = (base_past * len(baseline) + cand_past * len(candidate)) / (len(baseline) + len(candidate))
+    if pooled <= 0 or pooled >= 1:
+        return 1.0
+
+    error = math.sqrt(pooled * (1 - pooled) * (1 / len(baseline) + 1 / len(candidate)))
+    z = (cand_past - base_past) / error
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def has_tail_samples(samples, fraction):
+    """Returns true if there are enough samples past the percentile to test
+        it.
+    """
+    return len(samples) * (1 - fraction) >= MIN_TAIL_SAMPLES
+
+def compare_runs(baseline, candidate, threshold, alpha):
+    """Compares each request name found in both runs. Returns a list of
+        result dicts, one per name and metric.
+    """
+    results = []
+    for name in sorted(set(baseline) & set(candidate)):
+        base_samples = baseline[name]["samples"]
+        cand_samples = candidate[name]["samples"]
+
+        for metric, (_, higher_is_better, fraction) in METRICS.items():
+            base_value = baseline[name]["stats"][metric]
+            cand_value = candidate[name]["stats"][metric]
+            if base_value == None or cand_value == None or base_value == 0:
+                continue
+
+            # Positive change is always worse.
+            if higher_is_better:
+                change = (base_value - cand_value) / base_value
+            else:
+                change = (cand_value - base_value) / base_value
+
+            # Test each percentile on its own, if both runs have enough
+            # samples past it. Throughput has a single value per run, so it
+            # is checked against the threshold alone.
+            p_value = None
+            if fraction != None and has_tail_samples(base_samples, fraction) and has_tail_samples(cand_samples, fraction):
+                p_value = quantile_p_value(base_samples, cand_samples, fraction)
+            regression = change > threshold and (p_value == None or p_value < alpha)
+
+            results.append({
+                "name": name,
+                "metric": metric,
+                "baseline": base_value,
+                "candidate": cand_value,
+                "change": change,
+                "p_value": p_value,
+                "regression": regression,
+            })
+
+    return results
+
+def print_results(results, baseline, candidate):
+    """Prints the comparison table along with any unaligned names."""
+    print("{0:<40} {1:<5} {2:>12} {3:>12} {4:>9} {5:>8}".format("Name", "Stat", "Baseline", "Candidate", "Worse by", "p"))
+    for result in results:
+        if result["p_value"] == None:
+            p_value = "-"
+        else:
+            p_value = "{0:.4f}".format(result["p_value"])
+        print("{0:<40} {1:<5} {2:>12.2f} {3:>12.2f} {4:>8.1f}% {5:>8}{6}".format(
+            result["name"], result["metric"], result["baseline"], result["candidate"],
+            result["change"] * 100, p_value, "  REGRESSION" if result["regression"] else ""))
+
+    for name in sorted(set(baseline) - set(candidate)):
+        print("Only in baseline: " + name, file=sys.stderr)
+    for name in sorted(set(candidate) - set(baseline)):
+        print("Only in candidate: " + name, file=sys.stderr)
+
+def history_key(test_type, mte_type, total_pairs):
+    """Returns the key baselines are stored under."""
+    return "{0}/{1}/{2}".format(test_type, mte_type, total_pairs)
+
+def load_history(file_name):
+    """Loads the baseline history, or an empty one if it does not exist."""
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, "r") as file:
+        return json.load(file)
+
+def add_history(history, key, run, source, keep=HISTORY_KEEP):
+    """Adds the run as the latest baseline for the key, keeping only the
+        summary stats and at most SAMPLE_LIMIT samples per name. Aggregated
+        samples are not kept since they repeat every other name's. Only the
+        last keep baselines for the key are kept.
+    """
+    rows = {}
+    for name, entry in run.items():
+        rows[name] = {
+            "stats": entry["stats"],
+            "samples": [] if name == "Aggregated" else limit_samples(entry["samples"]),
+        }
+
+    baselines = history.setdefault(key, [])
+    baselines.append({
+        "time": datetime.now(timezone.utc).isoformat(),
+        "source": source,
+        "rows": rows,
+    })
+    del baselines[:-keep]
+
+def save_history(file_name, history):
+    """Writes the baseline history."""
+    with open(file_name, "w") as file:
+        json.dump(history, file, indent=1)
+
+def main():
+    """Compares a candidate locust run against a baseline run, or against the
+        latest stored baseline for its scenario, MTE type and pair count.
+        Exits with 1 if any request got significantly worse.
+    """
+    parser = argparse.ArgumentParser(description="Compare locust csv output against a baseline.")
+    parser.add_argument("candidate", help="--csv prefix of the run to check")
+    parser.add_argument("--baseline", help="--csv prefix of the run to compare against")
+    parser.add_argument("--history", help="json file of stored baselines")
+    parser.add_argument("--test_type", default="echo")
+    parser.add_argument("--mte_type", default="0")
+    parser.add_argument("--total_pairs", default="1")
+    parser.add_argument("--save", action="store_true", help="store the candidate as the new baseline if it passes")
+    parser.add_argument("--threshold", type=float, default=0.05, help="relative change allowed before a regression, default 0.05")
+    parser.add_argument("--alpha", type=float, default=0.05, help="significance level, default 0.05")
+    parser.add_argument("--keep", type=int, default=HISTORY_KEEP, help="baselines kept per key, default {0}".format(HISTORY_KEEP))
+    args = parser.parse_args()
+
+    if args.baseline == None and args.history == None:
+        parser.error("one of --baseline or --history is required")
+
+    candidate = load_run(args.candidate)
+
+    # Find the baseline to compare against.
+    key = history_key(args.test_type, args.mte_type, args.total_pairs)
+    history = {}
+    baseline = None
+    if args.baseline != None:
+        baseline = load_run(args.baseline)
+    else:
+        history = load_history(args.history)
+        if len(history.get(key, [])) > 0:
+            baseline = history[key][-1]["rows"]
+
+    regressions = []
+    if baseline == None:
+        print("No baseline stored for " + key + ".")
+    else:
+        results = compare_runs(baseline, candidate, args.threshold, args.alpha)
+        print_results(results, baseline, candidate)
+        regressions = [result for result in results if result["regression"]]
+
+    # Only passing runs become the new baseline.
+    if args.save and args.history != None and len(regressions) == 0:
+        if len(history) == 0:
+            history = load_history(args.history)
+        add_history(history, key, candidate, args.candidate, max(1, args.keep))
+        save_history(args.history, history)
+        print("Saved baseline for " + key + ".")
+
+    if len(regressions) > 0:
+        print("{0} regression(s) found.".format(len(regressions)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
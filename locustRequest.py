@@ -23,14 +23,26 @@
 # SOFTWARE.
 import sys
 from locust import HttpUser, task, between, run_single_user, events
+from locust.exception import StopUser
+from locust.runners import WorkerRunner
+import gevent
 import json
 import base64
 import urllib.parse
 import logging
+import os
+import time
 
 from MteBase import MteBase
 from MtePair import MtePair
+from MteOffload import MteOffload, LoopMonitor
 from MteStatus import MteStatus
+from TrafficTrace import TrafficRecorder, TrafficReplayer, SeededRandom
+from benchmarkCompare import TimingLog
+
+# MTE license, also used by offload worker processes.
+LICENSE_COMPANY = "LicenseCompany"
+LICENSE_KEY = "LicenseKey"
 
 class ApiUser(HttpUser): 
     """Class ApiUser 
@@ -49,14 +61,104 @@ class ApiUser(HttpUser):
         parser.add_argument(
             '--total_pairs'
             )
+        parser.add_argument(
+            '--record_trace'
+            )
+        parser.add_argument(
+            '--replay_trace'
+            )
+        parser.add_argument(
+            '--replay_speed'
+            )
+        parser.add_argument(
+            '--entropy_seed'
+            )
+        parser.add_argument(
+            '--encoding_mode'
+            )
+        parser.add_argument(
+            '--stage_timings', action='store_true'
+            )
+        parser.add_argument(
+            '--request_timings', action='store_true'
+            )
+        parser.add_argument(
+            '--kyber_strength'
+            )
+        parser.add_argument(
+            '--handshake_batches'
+            )
+        parser.add_argument(
+            '--offload'
+            )
+        parser.add_argument(
+            '--offload_threshold'
+            )
+        parser.add_argument(
+            '--offload_workers'
+            )
+        parser.add_argument(
+            '--loop_monitor', action='store_true'
+            )
+
+    @events.test_stop.add_listener
+    def close_trace(environment, **kwargs):
+        """Closes the trace file if one is being recorded."""
+        if ApiUser.traffic_recorder != None:
+            ApiUser.traffic_recorder.close()
+            ApiUser.traffic_recorder = None
+
+    @events.request.add_listener
+    def log_request_timing(request_type, name, response_time, response_length, **kwargs):
+        """Writes every request's latency to the timings file if
+            --request_timings is set.
+        """
+        if ApiUser.log_request_timings and ApiUser.timing_log != None:
+            ApiUser.timing_log.write(request_type, name, response_time, response_length)
+
+    @events.test_stop.add_listener
+    def close_offload(environment, **kwargs):
+        """Stops the offload workers and loop monitor if running."""
+        if ApiUser.mte_offload != None:
+            ApiUser.mte_offload.close()
+            ApiUser.mte_offload = None
+        if ApiUser.loop_monitor != None:
+            ApiUser.loop_monitor.stop()
+            print("Event loop blocked for {0:.3f}s total, {1:.1f}ms max.".format(
+                ApiUser.loop_monitor.total_blocked,
+                ApiUser.loop_monitor.max_blocked * 1000))
+            ApiUser.loop_monitor = None
+
+    # Registered after close_offload so the loop monitor has stopped writing.
+    @events.test_stop.add_listener
+    def close_timings(environment, **kwargs):
+        """Closes the timings file if one is being written."""
+        if ApiUser.timing_log != None:
+            ApiUser.timing_log.close()
+            ApiUser.timing_log = None
 
     logging.basicConfig(filename="errors.log",filemode='a',level = logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logging.getLogger().setLevel(logging.ERROR)
     # Simulate user wait time between tasks.
     wait_time = between(1, 5)
+
+    # Trace recorder/replayer shared by all users in this process.
+    traffic_recorder = None
+    traffic_replayer = None
+
+    # Total users started in this process, used to seed the entropy per user.
+    user_total = 0
+
+    # Timings file shared by all users in this process.
+    timing_log = None
+    log_request_timings = False
+
+    # Offload and loop monitor shared by all users in this process.
+    mte_offload = None
+    loop_monitor = None
    
     # Initialize MTE license. If a license code is not required (e.g., trial mode), this can be skipped.
-    if not MteBase.init_license("LicenseCompany", "LicenseKey"):
+    if not MteBase.init_license(LICENSE_COMPANY, LICENSE_KEY):
         status = MteStatus.mte_status_license_error
         print("this is a test")
         logging.error(f"Encountered an error with license: {status}")
@@ -86,6 +188,23 @@ class ApiUser(HttpUser):
            adipiscing commodo elit at imperdiet dui.\n\nFringilla urna 
            porttitor rhoncus dolor purus non enim praesent elementum. 
            Dictumst quisque"""
+
+        self.login_payload = {
+            'email': "trevor.blackman@eclypses.com",
+            'password': "P@ssw0rd!"
+        }
+
+        self.credit_payload = {
+            'creditCardNumber': "6489-6201-3912-5555",
+            'creditCardCVV': "958",
+            'creditCardIssuer': "visa",
+            'pin': "6524",
+            'name': "Trevor J Blackman",
+            'address': "1234 Elm Street",
+            'city': "Springfield",
+            'state': "IL",
+            'zip': "62701",
+        }
            
 
         # Set test type here or use --test_type command argument.
@@ -126,15 +245,187 @@ class ApiUser(HttpUser):
         if self.mte_pair_total > 300:
             self.mte_pair_total = 300
         
+        # encoding_mode:
+        # MTE base64 then percent-quoted: "b64"
+        # Unpadded URL-safe base64: "b64url"
+        # Set encoding mode here or use --encoding_mode command argument.
+        if self.environment.parsed_options.encoding_mode != None:
+            self.encoding_mode = self.environment.parsed_options.encoding_mode.strip().lower()
+
+        if not hasattr(self, 'encoding_mode') or self.encoding_mode not in ("b64", "b64url"):
+            self.encoding_mode = "b64"
+
+        # Kyber strength to use: 512, 768 or 1024. This is one strength for
+        # the whole run, as MteKyber.init may apply to the whole native
+        # library rather than to one instance.
+        # Set kyber strength here or use --kyber_strength command argument.
+        if self.environment.parsed_options.kyber_strength != None:
+            try:
+                self.kyber_strength = int(self.environment.parsed_options.kyber_strength)
+            except ValueError:
+                print("kyber_strength not properly set, using default.")
+
+        if hasattr(self, 'kyber_strength') and self.kyber_strength not in MtePair.KYBER_STRENGTHS:
+            print("kyber_strength must be 512, 768 or 1024, using default.")
+            self.kyber_strength = 512
+
+        if not hasattr(self, 'kyber_strength'):
+            self.kyber_strength = 512
+
+        # Pair counts per handshake for the "handshake" test type.
+        # Set batches here or use --handshake_batches command argument.
+        if self.environment.parsed_options.handshake_batches != None:
+            try:
+                self.handshake_batches = [int(batch) for batch in self.environment.parsed_options.handshake_batches.split(",")]
+            except ValueError:
+                print("handshake_batches not properly set, using default.")
+
+        if not hasattr(self, 'handshake_batches') or any(batch <= 0 or batch > 300 for batch in self.handshake_batches):
+            self.handshake_batches = [1, 10, 100]
+
         # The starting index.
         self.mte_pair_index = 0
 
+        # Set up trace recording and replay before any pairs are created.
+        self.setup_trace()
+
+        # Write request latencies to the timings file.
+        if self.environment.parsed_options.request_timings:
+            self.get_timing_log()
+            ApiUser.log_request_timings = True
+
+        # Set up offloading before any pairs are created.
+        self.setup_offload()
+
          # Create list of MtePair instances.
         self.mte_pair_list = self.add_mte_pairs(self.mte_pair_total)    
 
-    def add_mte_pairs(self, count):
+    def setup_trace(self):
+        """Sets up recording and/or replaying of the request trace based on
+            the --record_trace, --replay_trace, --replay_speed and
+            --entropy_seed command arguments.
+        """
+        options = self.environment.parsed_options
+
+        # Record this user's requests to the trace file.
+        self.trace_user_id = None
+        if options.record_trace != None:
+            if ApiUser.traffic_recorder == None:
+                ApiUser.traffic_recorder = TrafficRecorder(options.record_trace)
+            (self.trace_user_id, self.trace_time) = ApiUser.traffic_recorder.register_user()
+
+        # Replay a recorded user stream instead of the test_type.
+        self.traffic_stream = None
+        if options.replay_trace != None:
+            if ApiUser.traffic_replayer == None:
+                speed = 1.0
+                if options.replay_speed != None:
+                    try:
+                        speed = float(options.replay_speed)
+                    except ValueError:
+                        print("replay_speed not properly set, using default.")
+                ApiUser.traffic_replayer = TrafficReplayer(options.replay_trace, speed)
+            self.traffic_stream = ApiUser.traffic_replayer.next_stream()
+
+            # Timing comes from the trace, not from wait_time.
+            self.wait_time = lambda: 0
+
+        # Seed MTE entropy so pairs are the same between runs. Only use this
+        # against a local relay stand-in.
+        self.mte_rand = None
+        if options.entropy_seed != None:
+            # Seed per user so each user still gets its own pairs. Replayed
+            # streams that wrap around are told apart by their wrap count.
+            try:
+                if self.traffic_stream != None:
+                    self.mte_rand = SeededRandom(int(options.entropy_seed), "stream", self.traffic_stream.user_id, self.traffic_stream.wrap)
+                else:
+                    self.mte_rand = SeededRandom(int(options.entropy_seed), "user", ApiUser.user_total)
+            except ValueError:
+                print("entropy_seed not properly set, not seeding.")
+
+        ApiUser.user_total += 1
+
+    def setup_offload(self):
+        """Sets up offloading of large MTE operations and the event loop
+            monitor based on the --offload, --offload_threshold,
+            --offload_workers and --loop_monitor command arguments.
+        """
+        options = self.environment.parsed_options
+
+        # offload:
+        # Run on the gevent loop: "none"
+        # Native threads: "thread"
+        # Worker processes: "process"
+        if options.offload != None and options.offload.strip().lower() in ("thread", "process") and ApiUser.mte_offload == None:
+            # Offload messages of at least this many bytes, by default the
+            # 25 kb and 50 kb payloads.
+            threshold = 16384
+            if options.offload_threshold != None:
+                try:
+                    threshold = int(options.offload_threshold)
+                except ValueError:
+                    print("offload_threshold not properly set, using default.")
+
+            workers = os.cpu_count() or 1
+            if options.offload_workers != None:
+                try:
+                    workers = max(1, int(options.offload_workers))
+                except ValueError:
+                    print("offload_workers not properly set, using default.")
+
+            ApiUser.mte_offload = MteOffload(options.offload.strip().lower(), threshold, workers, LICENSE_COMPANY, LICENSE_KEY)
+
+        # Write how long the event loop is blocked as "LOOP" timings.
+        if options.loop_monitor and ApiUser.loop_monitor == None:
+            ApiUser.loop_monitor = LoopMonitor(0.1, self.log_loop_blocked)
+            ApiUser.loop_monitor.start()
+
+    def log_loop_blocked(self, seconds):
+        """Writes time the event loop was blocked to the timings file as a
+            "LOOP" timing.
+        """
+        self.get_timing_log().write("LOOP", "event-loop-blocked", seconds * 1000, 0)
+
+    def record_request(self, name, header_type, payload, query_string, method):
+        """Writes the request to the trace if recording."""
+        if self.trace_user_id == None or ApiUser.traffic_recorder == None:
+            return
+
+        self.trace_time = ApiUser.traffic_recorder.record(self.trace_user_id, self.trace_time, self.test_type, name, header_type, payload, query_string, method)
+
+    def get_timing_log(self):
+        """Returns the timings file for this process, creating it as
+            PREFIX_timings_PID.csv from the --csv prefix if needed. Timings
+            are kept out of the locust request stats so they do not change
+            them.
+        """
+        if ApiUser.timing_log == None:
+            prefix = self.environment.parsed_options.csv_prefix
+            if not prefix:
+                prefix = "locust"
+            ApiUser.timing_log = TimingLog(prefix)
+
+            # Workers write on their own host, not next to the master's csv.
+            if isinstance(self.environment.runner, WorkerRunner):
+                print("Timings are written on this worker's host, copy them next to the master's --csv output before comparing.")
+
+        return ApiUser.timing_log
+
+    def log_stage(self, base_url, stage, start_time, size):
+        """Writes the time since start_time to the timings file as a "STAGE"
+            timing if --stage_timings is set, e.g. "STAGE /api/login encode_url".
+        """
+        if not self.environment.parsed_options.stage_timings:
+            return
+
+        self.get_timing_log().write("STAGE", base_url + " " + stage, (time.perf_counter() - start_time) * 1000, size)
+
+    def add_mte_pairs(self, count, profile=False):
         """Communicates with the MTE server to establish MTE encoder/decoder
-            pairs using the MTE kyber implementation."""
+            pairs using the MTE kyber implementation. If profile is set, the
+            handshake costs are written to the timings file.
+        """
         # Perform a HEAD request to get the client_id.
         response = self.client.head("api/mte-relay")
 
@@ -142,6 +433,13 @@ class ApiUser(HttpUser):
         if not hasattr(self, 'client_id'):
             self.client_id = response.headers.get('x-mte-relay', 'Header not present')
 
+            # Only use URL-safe encoding if the relay lists "b64url" in its
+            # comma separated "x-mte-relay-features" header.
+            features = [feature.strip().lower() for feature in response.headers.get('x-mte-relay-features', '').split(",")]
+            if self.encoding_mode == "b64url" and "b64url" not in features:
+                print("Relay does not support b64url encoding, using b64.")
+                self.encoding_mode = "b64"
+
         # Variable for holding number of failures - used currently to track catastrophic failures.
         self.fail_num = 0       
 
@@ -154,7 +452,7 @@ class ApiUser(HttpUser):
         # Loop to create all needed MTE pairs.
         for i in range(count):
             # Create new MtePair.
-            m_pair = MtePair(self.mte_type)
+            m_pair = MtePair(self.mte_type, self.mte_rand, self.kyber_strength, ApiUser.mte_offload)
 
             # Create payload for the "api/mte-pair" call.
             payload = {
@@ -165,6 +463,11 @@ class ApiUser(HttpUser):
                 "decoderPublicKey": base64.b64encode(m_pair.dec_pub_key).decode("utf-8")
             }
 
+            # Only sent when not the default so the payload is unchanged for
+            # relays that only support 512.
+            if m_pair.kyber_strength != 512:
+                payload["kyberStrength"] = m_pair.kyber_strength
+
             # Append to the MTE pair list.
             mte_pair_list.append(m_pair)
 
@@ -180,8 +483,18 @@ class ApiUser(HttpUser):
             'Content-Type': 'application/json'
         }
 
+        # Name profiled handshakes by strength and batch size.
+        profile_name = None
+        if profile:
+            profile_name = "kyber{0} x{1}".format(self.kyber_strength, count)
+
         # Post to "api/mte-pair".
-        response = self.client.post("api/mte-pair", headers=headers, data=payload)
+        post_time = time.perf_counter()
+        if profile_name != None:
+            response = self.client.post("api/mte-pair", name="/api/mte-pair " + profile_name, headers=headers, data=payload)
+        else:
+            response = self.client.post("api/mte-pair", headers=headers, data=payload)
+        post_time = time.perf_counter() - post_time
 
         # Check if response is valid.
         if response == None:
@@ -206,9 +519,23 @@ class ApiUser(HttpUser):
             if status != MteStatus.mte_status_success:
                 sys.exit("Failed to setup MTE pair: " + str(status))
 
+        if profile_name != None:
+            # Total time for the whole batch of each handshake step.
+            self.log_handshake(profile_name, "keygen", sum(m_pair.keygen_time for m_pair in mte_pair_list), sum(len(m_pair.enc_pub_key) + len(m_pair.dec_pub_key) for m_pair in mte_pair_list))
+            self.log_handshake(profile_name, "decrypt_secret", sum(m_pair.decrypt_time for m_pair in mte_pair_list), 0)
+            self.log_handshake(profile_name, "instantiate", sum(m_pair.instantiate_time for m_pair in mte_pair_list), 0)
+            # Round trip along with the JSON body bytes sent and received.
+            self.log_handshake(profile_name, "wire", post_time, len(payload) + len(response.content))
+
         # Return local pair list.
         return mte_pair_list                
 
+    def log_handshake(self, profile_name, step, seconds, size):
+        """Writes a handshake step to the timings file as a "HANDSHAKE"
+            timing, e.g. "HANDSHAKE kyber768 x10 keygen".
+        """
+        self.get_timing_log().write("HANDSHAKE", profile_name + " " + step, seconds * 1000, size)
+
     def replace_mte_pair(self, mte_pair):   
         """Removes an MTE pair from the list and then adds one."""
         # Remove the MtePair.   
@@ -235,8 +562,13 @@ class ApiUser(HttpUser):
     @task
     def test(self):      
         """The test that locust will call upon at th intervals supplied. This 
-            will pick the test based on test_type.
+            will pick the test based on test_type, or the next request from the
+            trace if replaying.
         """
+        if self.traffic_stream != None:
+            self.mte_replay()
+            return
+
         # If no test_type or not in the list, then use echo.       
         if self.test_type.strip().lower() == "login":
             self.mte_login()
@@ -252,11 +584,63 @@ class ApiUser(HttpUser):
             self.mte_twenty_five_kb()
         elif self.test_type.strip().lower() == "fiftykb" or self.test_type.strip().lower() == "50kb":
             self.mte_fifty_kb()
+        elif self.test_type.strip().lower() == "handshake":
+            self.mte_handshake()
         else:
             self.mte_echo()      
 
+    def mte_replay(self):
+        """Sends the next request from the replayed trace once its recorded
+            arrival time is reached. Stops the user when the trace is done.
+        """
+        (entry, delay) = self.traffic_stream.next_entry()
+        if entry == None:
+            raise StopUser()
+
+        gevent.sleep(delay)
+
+        # No name means the plain echo test.
+        if entry["n"] == None:
+            self.mte_echo()
+            return
+
+        (status, response) = self.encode_and_send_message(name=entry["n"], header_type=entry["h"], payload=self.replay_payload(entry), query_string=entry["q"], method=entry["m"])
+
+    def replay_payload(self, entry):
+        """Rebuilds the payload of a traced request. Only the size is
+            recorded, so the fixed login and credit card payloads are reused
+            and anything else is rebuilt from the placeholder text.
+        """
+        if not entry["p"]:
+            return None
+        if entry["n"] == "login":
+            return self.login_payload
+        if entry["n"] == "credit-card":
+            return self.credit_payload
+
+        # Number of placeholder copies giving the recorded size.
+        overhead = len(json.dumps({'data': ''}))
+        one_kb_size = len(json.dumps(self.one_kb)) - 2
+        count = max(1, round((entry["p"] - overhead) / one_kb_size))
+
+        return {
+            'data': self.one_kb * count,
+        }
+
+    def mte_handshake(self):
+        """Profiles the handshake for each batch size at this run's kyber
+            strength. The pairs created are only used for profiling and are
+            discarded.
+        """
+        for batch in self.handshake_batches:
+            self.add_mte_pairs(batch, profile=True)
+
+        pass
+
     def mte_echo(self):
         """The basic echo test without any MTE involvment."""
+        self.record_request(name=None, header_type=None, payload=None, query_string=None, method="get")
+
         response = self.client.get("api/mte-echo/test")
 
         pass
@@ -265,13 +649,7 @@ class ApiUser(HttpUser):
         """Performs the login test with a "valid" user and password that will
             be encoded and then sent to the server.
         """
-        # Create payload to deliver with the post.
-        login_payload = {
-            'email': "trevor.blackman@eclypses.com",
-            'password': "P@ssw0rd!"
-        }
-       
-        (status, response) = self.encode_and_send_message(name="login", header_type=None, payload=login_payload, query_string=None, method=None)
+        (status, response) = self.encode_and_send_message(name="login", header_type=None, payload=self.login_payload, query_string=None, method=None)
                       
         pass
 
@@ -288,20 +666,7 @@ class ApiUser(HttpUser):
         """Performs the credit card test with a credit card sample to encode
         and send to the server."""
 
-        # Create payload to deliver with the post.
-        credit_payload = {
-            'creditCardNumber': "6489-6201-3912-5555",
-            'creditCardCVV': "958",
-            'creditCardIssuer': "visa",
-            'pin': "6524",
-            'name': "Trevor J Blackman",
-            'address': "1234 Elm Street",
-            'city': "Springfield",
-            'state': "IL",
-            'zip': "62701",
-        }
-
-        (status, response) = self.encode_and_send_message(name="credit-card", header_type=None, payload=credit_payload, query_string=None, method=None)
+        (status, response) = self.encode_and_send_message(name="credit-card", header_type=None, payload=self.credit_payload, query_string=None, method=None)
 
         pass
 
@@ -353,6 +718,9 @@ class ApiUser(HttpUser):
         limit = 5 # The number of attempts before giving up.
         attempts = 0
 
+        # Record the request once, regardless of retries.
+        self.record_request(name, header_type, payload, query_string, method)
+
         while successful == False and attempts < limit:
             # Get the MTE pair based off current index.
             mte_pair = self.mte_pair_list[self.mte_pair_index]     
@@ -367,7 +735,12 @@ class ApiUser(HttpUser):
 
             encoded_url = ""
             # Encode the api path with MTE base64 for use in api post request path.
-            (encoded_url, status) = mte_pair.encode_b64(url)
+            stage_time = time.perf_counter()
+            if self.encoding_mode == "b64url":
+                (encoded_url, status) = mte_pair.encode_b64url(url)
+            else:
+                (encoded_url, status) = mte_pair.encode_b64(url)
+            self.log_stage(base_url, "encode_url", stage_time, len(url))
 
             # Check if base 64 encoding was successful.
             if status != MteStatus.mte_status_success:
@@ -386,7 +759,12 @@ class ApiUser(HttpUser):
             # Stringify the header to be MTE encoded.
             header_string = json.dumps(header)
 
-            (encoded_header, status) = mte_pair.encode_b64(header_string)
+            stage_time = time.perf_counter()
+            if self.encoding_mode == "b64url":
+                (encoded_header, status) = mte_pair.encode_b64url(header_string)
+            else:
+                (encoded_header, status) = mte_pair.encode_b64(header_string)
+            self.log_stage(base_url, "encode_header", stage_time, len(header_string))
             # Check if base 64 encoding was successful.
             if status != MteStatus.mte_status_success:
                 print("Failed to encode the header.")
@@ -400,6 +778,7 @@ class ApiUser(HttpUser):
             # isUrlEncoded: 0 false, 1 true,
             # isHeaders Encoded: 0 false, 1 true,
             # is Body encoded: 0 false, 1 true
+            # isUrlSafe (only sent if 1): url and header use unpadded URL-safe base64
             mte_header_info = self.client_id + ',' + mte_pair.pair_id + "," + str(self.mte_type) + ",1,1,"
 
             # Check if there is a payload. Append appropriate header info.            
@@ -411,7 +790,9 @@ class ApiUser(HttpUser):
                 payload_string = json.dumps(payload)
 
                 # Encode the payload with MTE for use in api post data variable.
+                stage_time = time.perf_counter()
                 (encoded_payload, status) = mte_pair.encode(payload_string)
+                self.log_stage(base_url, "encode_payload", stage_time, len(payload_string))
 
                 # Check if encoding was successful.
                 if status != MteStatus.mte_status_success:
@@ -422,6 +803,12 @@ class ApiUser(HttpUser):
                 mte_header_info += "0"
                 content_type = "application/json; charset=utf-8"
 
+            # Flag URL-safe encoding to the relay. This is only used once the
+            # relay has advertised support, and is left off otherwise so the
+            # header is unchanged for relays that do not know the flag.
+            if self.encoding_mode == "b64url":
+                mte_header_info += ",1"
+
             # Create request header that will include the base 64 encoded header info.
             # Determine content based on type.
             headers = {
@@ -432,7 +819,11 @@ class ApiUser(HttpUser):
             }         
 
             # Parse URL to change unprintable characters that would confuse the system.
-            parsed_url = urllib.parse.quote(encoded_url)
+            # URL-safe output needs no quoting.
+            if self.encoding_mode == "b64url":
+                parsed_url = encoded_url
+            else:
+                parsed_url = urllib.parse.quote(encoded_url)
 
             # Send the post request to server.
             # Check method type. If more method types, expand here.
@@ -0,0 +1,89 @@
+# The MIT License (MIT)
+#
+# Copyright (c) Eclypses, Inc.
+#
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+import random
+import unittest
+
+import benchmarkCompare
+from benchmarkCompare import METRICS, add_history, compare_runs, percentile
+
+def make_run(samples):
+    """Builds a run for a single request name from its latency samples."""
+    stats = {metric: (percentile(samples, fraction) if fraction != None else 20.0) for metric, (_, _, fraction) in METRICS.items()}
+    return {"POST /api/login": {"stats": stats, "samples": samples}}
+
+def regressions(results):
+    """Returns the metrics flagged as regressions."""
+    return sorted(result["metric"] for result in results if result["regression"])
+
+class CompareRunsTest(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.baseline = [rand.uniform(5, 12) for i in range(5000)]
+
+    def test_tail_only_regression(self):
+        """Only the slowest 1.5% of requests got 10x slower."""
+        candidate = sorted(self.baseline)
+        tail = int(len(candidate) * 0.015)
+        candidate = candidate[:-tail] + [value * 10 for value in candidate[-tail:]]
+
+        results = compare_runs(make_run(self.baseline), make_run(candidate), 0.05, 0.05)
+
+        self.assertEqual(regressions(results), ["p99"])
+
+    def test_same_distribution(self):
+        rand = random.Random(2)
+        candidate = [rand.uniform(5, 12) for i in range(5000)]
+
+        results = compare_runs(make_run(self.baseline), make_run(candidate), 0.05, 0.05)
+
+        self.assertEqual(regressions(results), [])
+
+    def test_too_few_samples_uses_threshold(self):
+        """Too few samples past p99 to test, so the threshold decides."""
+        baseline = self.baseline[:100]
+        candidate = sorted(baseline)[:-2] + [1000.0, 1000.0]
+
+        results = compare_runs(make_run(baseline), make_run(candidate), 0.05, 0.05)
+
+        p99 = [result for result in results if result["metric"] == "p99"][0]
+        self.assertIsNone(p99["p_value"])
+        self.assertTrue(p99["regression"])
+
+class HistoryTest(unittest.TestCase):
+
+    def test_add_history_is_compact(self):
+        run = make_run([float(i) for i in range(10000)])
+        run["Aggregated"] = {"stats": {}, "samples": [1.0] * 10000}
+
+        history = {}
+        for i in range(5):
+            add_history(history, "login/0/1", run, "run" + str(i), keep=3)
+
+        baselines = history["login/0/1"]
+        self.assertEqual([baseline["source"] for baseline in baselines], ["run2", "run3", "run4"])
+        self.assertEqual(len(baselines[-1]["rows"]["POST /api/login"]["samples"]), benchmarkCompare.SAMPLE_LIMIT)
+        self.assertEqual(baselines[-1]["rows"]["Aggregated"]["samples"], [])
+
+if __name__ == "__main__":
+    unittest.main()